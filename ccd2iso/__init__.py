@@ -4,17 +4,39 @@
 
 """Tool to convert CloneCD .img files to ISO 9660 .iso files."""
 
-from typing import Any
+from typing import Any, Optional
 from io import BytesIO
-from ccd2iso.clonecd import ccd_sector
+from ccd2iso.clonecd import DATA_SIZE, SECTOR_SIZE, MODE_OFFSET, MODE1_DATA_OFFSET, MODE2_DATA_OFFSET
 import contextlib
+import functools
+import io
+import mmap
 import os
-import progressbar
-from ctypes import sizeof
+import queue
+import stat
 import sys
+import threading
+
+try:
+    from ccd2iso._core import extract_sectors as _extract_sectors_compiled
+except ImportError:
+    _extract_sectors_compiled = None
 
 __version__ = "0.0.1"
 
+# Number of sectors converted per read/write, about 2.3 MB of .img data
+CHUNK_SECTORS = 1024
+
+# Sectors per chunk when copying between memory maps without a progress bar,
+# 64 MiB of ISO data. Still bounded so Ctrl-C is handled between chunks.
+BULK_CHUNK_SECTORS = 32768
+
+# Buffer size for the files opened by main(), instead of the default 8 KiB
+BUFFER_SIZE = 1 << 20
+
+# Offset of the data within a sector, by sector mode
+_DATA_OFFSETS = {1: MODE1_DATA_OFFSET, 2: MODE2_DATA_OFFSET}
+
 class IncompleteSectorError(Exception):
     """Raised when there are less bytes in the sector than expected."""
     pass
@@ -34,6 +56,340 @@ class UnrecognizedSectorModeError(Exception):
     pass
 
 
+class _NoProgress(contextlib.nullcontext):
+    """Stands in for a progress bar when progress isn't shown."""
+
+    def update(self, value: int) -> None:
+        pass
+
+
+def _os_file(file: BytesIO) -> Optional[io.IOBase]:
+    """Returns file if its bytes are the bytes of its fileno(), or None.
+
+    Wrappers like gzip.GzipFile have a fileno() too, but it's the compressed
+    file underneath, so only plain file objects are accepted. Temporary files
+    are unwrapped to the file object inside.
+    """
+    tempfile = sys.modules.get('tempfile')
+    if tempfile and isinstance(file, tempfile._TemporaryFileWrapper):
+        file = file.file
+    if isinstance(file, (io.FileIO, io.BufferedReader, io.BufferedWriter, io.BufferedRandom)):
+        return file
+    return None
+
+
+def _map_source(src_file: BytesIO) -> Optional[mmap.mmap]:
+    """Memory-maps src_file for reading, or returns None if it can't be mapped.
+
+    Streams that aren't plain files (such as BytesIO or GzipFile), pipes and
+    empty files can't be mapped, and are read in chunks instead.
+    """
+    if _os_file(src_file) is None:
+        return None
+
+    try:
+        src_map = mmap.mmap(src_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    # Sectors are only read once, front to back
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        src_map.madvise(mmap.MADV_SEQUENTIAL)
+    return src_map
+
+
+def _map_destination(dst_file: BytesIO, length: int) -> Optional[mmap.mmap]:
+    """Extends dst_file by length bytes and memory-maps it for writing.
+
+    Returns None if dst_file can't be mapped, such as when it isn't a regular
+    file, isn't readable, or isn't positioned at its end. Also returns None if
+    the space can't be reserved, so the write() path reports a full disk as an
+    OSError instead of the mapping crashing with SIGBUS.
+    """
+    if not length or _os_file(dst_file) is None or not dst_file.seekable():
+        return None
+    fileno = dst_file.fileno()
+    if not stat.S_ISREG(os.fstat(fileno).st_mode):
+        return None
+
+    dst_file.flush()
+    end = dst_file.tell()
+    if os.fstat(fileno).st_size != end:
+        return None
+
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fileno, end, length)
+        else:
+            # Without fallocate the file is only extended sparsely, so running
+            # out of disk space while writing through the map raises SIGBUS
+            os.ftruncate(fileno, end + length)
+        return mmap.mmap(fileno, end + length, access=mmap.ACCESS_WRITE)
+    except (OSError, ValueError):
+        with contextlib.suppress(OSError):
+            os.ftruncate(fileno, end)
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _import_numpy() -> Any:
+    """Imports NumPy, or returns None if it's missing or won't import.
+
+    NumPy is slow to import, so this is only done once a conversion needs it.
+    progressbar2 is imported late for the same reason.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _count_convertible(src: memoryview) -> int:
+    """Returns how many whole sectors at the start of src are mode 1 or mode 2."""
+    sect_count = len(src) // SECTOR_SIZE
+    modes = bytes(src[MODE_OFFSET:sect_count * SECTOR_SIZE:SECTOR_SIZE])
+    return len(modes) - len(modes.lstrip(b'\x01\x02'))
+
+
+def _extract_sectors_python(src: memoryview, dst: memoryview) -> int:
+    """Copies the data from each whole sector in src into dst.
+
+    Stops at the first sector that isn't mode 1 or mode 2, and returns the
+    number of sectors copied.
+    """
+    sect_count = len(src) // SECTOR_SIZE
+
+    # The header is only needed for its mode byte, and gathering every mode in
+    # one strided copy beats unpacking each header with struct or ctypes
+    modes = bytes(src[MODE_OFFSET:sect_count * SECTOR_SIZE:SECTOR_SIZE])
+
+    # Fast path for the usual all mode 1 image
+    if modes.count(1) == sect_count:
+        for i in range(sect_count):
+            start = i * SECTOR_SIZE + MODE1_DATA_OFFSET
+            dst[i * DATA_SIZE:(i + 1) * DATA_SIZE] = src[start:start + DATA_SIZE]
+        return sect_count
+
+    for i, mode in enumerate(modes):
+        data_offset = _DATA_OFFSETS.get(mode)
+        if data_offset is None:
+            return i
+        start = i * SECTOR_SIZE + data_offset
+        dst[i * DATA_SIZE:(i + 1) * DATA_SIZE] = src[start:start + DATA_SIZE]
+    return sect_count
+
+
+def _extract_sectors_numpy(src: memoryview, dst: memoryview) -> int:
+    """Same as _extract_sectors_python(), but vectorized with NumPy."""
+    numpy = _import_numpy()
+
+    sect_count = len(src) // SECTOR_SIZE
+    if not sect_count:
+        return 0
+
+    # Views of src and dst kept alive by a traceback would stop the caller from
+    # releasing them, so they're all dropped on the way out
+    sectors = data = modes = mode1_data = mode2_data = None
+    try:
+        sectors = numpy.frombuffer(src, numpy.uint8, sect_count * SECTOR_SIZE).reshape(sect_count, SECTOR_SIZE)
+        data = numpy.frombuffer(dst, numpy.uint8, sect_count * DATA_SIZE).reshape(sect_count, DATA_SIZE)
+        modes = sectors[:, MODE_OFFSET]
+
+        # Fast path for the usual all mode 1 image
+        mode1_data = sectors[:, MODE1_DATA_OFFSET:MODE1_DATA_OFFSET + DATA_SIZE]
+        if (modes == 1).all():
+            data[:] = mode1_data
+            return sect_count
+
+        bad = numpy.flatnonzero((modes != 1) & (modes != 2))
+        converted = int(bad[0]) if bad.size else sect_count
+        mode1 = (modes[:converted] == 1)[:, numpy.newaxis]
+        mode2_data = sectors[:converted, MODE2_DATA_OFFSET:MODE2_DATA_OFFSET + DATA_SIZE]
+        numpy.copyto(data[:converted], mode1_data[:converted], where=mode1)
+        numpy.copyto(data[:converted], mode2_data, where=~mode1)
+        return converted
+    finally:
+        del sectors, data, modes, mode1_data, mode2_data
+
+
+def _extract_sectors(src: memoryview, dst: memoryview) -> int:
+    """Runs the fastest available version of _extract_sectors_python()."""
+    if _extract_sectors_compiled:
+        return _extract_sectors_compiled(src, dst)
+    if _import_numpy() is not None:
+        return _extract_sectors_numpy(src, dst)
+    return _extract_sectors_python(src, dst)
+
+
+def _check_chunk(src: memoryview, converted: int, sect_num: int) -> None:
+    """Raises an error if _extract_sectors() didn't convert all of src.
+
+    src -- sectors passed to _extract_sectors()
+    converted -- number of sectors _extract_sectors() converted
+    sect_num -- number of the first sector that wasn't converted
+    """
+    offset = converted * SECTOR_SIZE
+    if converted < len(src) // SECTOR_SIZE:
+        mode = src[offset + MODE_OFFSET]
+        if mode == 0xE2:
+            raise SessionMarkerError(
+                'Error: Found a session marker, this image might contain multisession data. Only the first session was exported.')
+        raise UnrecognizedSectorModeError('Error: Unrecognized sector mode (%x) at sector %d!' %
+                                          (mode, sect_num))
+    if offset < len(src):
+        raise IncompleteSectorError(
+            'Error: Sector %d is incomplete, with only %d bytes instead of %d. This might not be a CloneCD disc image.' %
+            (sect_num, len(src) - offset, SECTOR_SIZE))
+
+
+def _read_chunk(src_file: BytesIO, buffer: memoryview) -> int:
+    """Fills buffer from src_file, returning the number of bytes read.
+
+    Pipes and unbuffered streams can return less than asked for, so this keeps
+    reading until the buffer is full or src_file runs out.
+    """
+    bytes_read = 0
+    while bytes_read < len(buffer):
+        with buffer[bytes_read:] as free:
+            read = src_file.readinto(free)
+        if not read:
+            break
+        bytes_read += read
+    return bytes_read
+
+
+def _read_ahead(src_file: BytesIO, free: queue.Queue, full: queue.Queue) -> None:
+    """Fills buffers taken from free with chunks of src_file, and passes them to full.
+
+    Runs on its own thread, so the next chunk is read while the current one is
+    being converted. Stops at the end of src_file, when free hands it None, or
+    when reading fails, passing the error on to full instead of a buffer.
+    """
+    try:
+        while (buffer := free.get()) is not None:
+            bytes_read = _read_chunk(src_file, buffer)
+            full.put((buffer, bytes_read))
+            if not bytes_read:
+                return
+    except BaseException as error:
+        full.put((None, error))
+
+
+def _convert_stream(src_file: BytesIO, dst_file: BytesIO, context: Any) -> None:
+    """Converts src_file by reading chunks into a pair of buffers.
+
+    The buffers are read ahead of the conversion. If src_file is seekable, it's
+    moved back to the first sector that wasn't converted afterwards. Otherwise
+    its position is undefined after an error.
+    """
+    sect_num = 0
+    start = src_file.tell() if src_file.seekable() else None
+    chunk_size = CHUNK_SECTORS * SECTOR_SIZE
+    out_buffer = bytearray(CHUNK_SECTORS * DATA_SIZE)
+
+    # One buffer gets converted while the reader fills the other
+    free = queue.Queue()
+    full = queue.Queue()
+    for _ in range(2):
+        free.put(memoryview(bytearray(chunk_size)))
+    reader = threading.Thread(target=_read_ahead, args=(src_file, free, full), daemon=True)
+    reader.start()
+
+    try:
+        with memoryview(out_buffer) as out_view:
+            while True:
+                in_view, bytes_read = full.get()
+                if in_view is None:
+                    raise bytes_read
+                if not bytes_read:
+                    break
+
+                with in_view[:bytes_read] as chunk:
+                    converted = _extract_sectors(chunk, out_view)
+                    dst_file.write(out_view[:converted * DATA_SIZE])
+                    sect_num += converted
+                    _check_chunk(chunk, converted, sect_num)
+                free.put(in_view)
+
+                context.update(sect_num)
+    finally:
+        free.put(None)
+        reader.join()
+        if start is not None:
+            src_file.seek(start + sect_num * SECTOR_SIZE)
+
+
+def _convert_mapped(src_file: BytesIO, src_map: mmap.mmap, dst_file: BytesIO, context: Any,
+                    progress: bool) -> None:
+    """Converts src_file through its memory map src_map.
+
+    The data is copied straight into a memory map of dst_file if possible, and
+    written through a buffer otherwise. Without progress to report, the copy
+    between memory maps uses larger chunks.
+    """
+    sect_num = 0
+    chunk_size = CHUNK_SECTORS * SECTOR_SIZE
+
+    # Start from the stream's current position, like read() would
+    start = src_file.tell()
+
+    with src_map, memoryview(src_map) as src_view:
+        # Find where conversion has to stop before copying anything, so the
+        # chunks before it don't need checking and the ISO size is exact
+        with src_view[start:] as sectors:
+            end = start + _count_convertible(sectors) * SECTOR_SIZE
+        length = (end - start) // SECTOR_SIZE * DATA_SIZE
+
+        dst_map = _map_destination(dst_file, length)
+
+        # Destinations that can't be mapped, like write-only files, get the
+        # data through a buffer. os.copy_file_range() would keep it in the
+        # kernel, but it needs a call per 2048 byte sector since the data isn't
+        # contiguous in the image, which made it about twice as slow.
+        if dst_map is None:
+            out_buffer = bytearray(CHUNK_SECTORS * DATA_SIZE)
+            with memoryview(out_buffer) as out_view:
+                try:
+                    for offset in range(start, end, chunk_size):
+                        with src_view[offset:min(offset + chunk_size, end)] as chunk:
+                            sect_num += _extract_sectors(chunk, out_view)
+                            dst_file.write(out_view[:len(chunk) // SECTOR_SIZE * DATA_SIZE])
+
+                        context.update(sect_num)
+
+                    with src_view[end:] as rest:
+                        _check_chunk(rest, 0, sect_num)
+                finally:
+                    src_file.seek(start + sect_num * SECTOR_SIZE)
+            return
+
+        # Small chunks are only needed here to report progress
+        if not progress:
+            chunk_size = BULK_CHUNK_SECTORS * SECTOR_SIZE
+
+        dst_start = len(dst_map) - length
+        try:
+            with dst_map, memoryview(dst_map) as dst_view:
+                for offset in range(start, end, chunk_size):
+                    out_offset = dst_start + sect_num * DATA_SIZE
+                    with src_view[offset:min(offset + chunk_size, end)] as chunk, \
+                            dst_view[out_offset:out_offset + chunk_size // SECTOR_SIZE * DATA_SIZE] as out:
+                        sect_num += _extract_sectors(chunk, out)
+
+                    context.update(sect_num)
+
+            with src_view[end:] as rest:
+                _check_chunk(rest, 0, sect_num)
+        finally:
+            # Drop the space reserved for sectors that were never converted
+            dst_end = dst_start + sect_num * DATA_SIZE
+            if dst_end < dst_start + length:
+                os.ftruncate(dst_file.fileno(), dst_end)
+            dst_file.seek(dst_end)
+            src_file.seek(start + sect_num * SECTOR_SIZE)
+
+
 def convert(src_file: BytesIO, dst_file: BytesIO, progress: bool = False, size: int = None) -> None:
     """Converts a CloneCD disc image bytestream to an ISO 9660 bytestream.
 
@@ -43,34 +399,26 @@ def convert(src_file: BytesIO, dst_file: BytesIO, progress: bool = False, size:
     size -- size of src_file, used to calculate sectors remaining for progress
     """
 
-    sect_num = 0
-    expected_size = sizeof(ccd_sector)
-    max_value = int(size/expected_size) if size else progressbar.UnknownLength
-    context = progressbar.ProgressBar(max_value=max_value) if progress else contextlib.nullcontext()
+    if progress:
+        import progressbar
+        max_value = int(size/SECTOR_SIZE) if size else progressbar.UnknownLength
+        context = progressbar.ProgressBar(max_value=max_value)
+    else:
+        context = _NoProgress()
 
+    src_map = _map_source(src_file)
     with context:
-        while bytes_read := src_file.read(expected_size):
-            src_sect = ccd_sector.from_buffer_copy(bytes_read)
-            if sizeof(src_sect) < expected_size:
-                raise IncompleteSectorError(
-                    'Error: Sector %d is incomplete, with only %d bytes instead of %d. This might not be a CloneCD disc image.' %
-                    (sect_num, sizeof(src_sect), expected_size))
-
-            if src_sect.sectheader.header.mode == 1:
-                bytes_written = dst_file.write(src_sect.content.mode1.data)
-            elif src_sect.sectheader.header.mode == 2:
-                bytes_written = dst_file.write(src_sect.content.mode2.data)
-            elif src_sect.sectheader.header.mode == b'\xe2':
-                raise SessionMarkerError(
-                    'Error: Found a session marker, this image might contain multisession data. Only the first session was exported.')
-            else:
-                raise UnrecognizedSectorModeError('Error: Unrecognized sector mode (%x) at sector %d!' %
-                                                  (src_sect.sectheader.header.mode, sect_num))
-
-            sect_num += 1
-
-            if progress:
-                context.update(sect_num)
+        if src_map is None:
+            _convert_stream(src_file, dst_file, context)
+        else:
+            _convert_mapped(src_file, src_map, dst_file, context, progress)
+
+
+def _advise_sequential(file: BytesIO) -> None:
+    """Tells the OS that file will be accessed front to back, where supported."""
+    if hasattr(os, 'posix_fadvise'):
+        with contextlib.suppress(OSError):
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
 
 
 def main():
@@ -118,10 +466,11 @@ def main():
 
     # Check source file
     try:
-        src_file = open(args.img, 'rb')
+        src_file = open(args.img, 'rb', buffering=BUFFER_SIZE)
     except FileNotFoundError as error:
         print("Error: Couldn't find the file", error.filename)
         sys.exit(1)
+    _advise_sequential(src_file)
 
     # Set up destination file
     import tempfile
@@ -134,7 +483,8 @@ def main():
         sys.exit(1)
 
     dst_file = tempfile.NamedTemporaryFile(
-        dir=os.path.dirname(args.iso), delete=False)
+        buffering=BUFFER_SIZE, dir=os.path.dirname(args.iso), delete=False)
+    _advise_sequential(dst_file)
 
     # Run conversion
     try:
@@ -4,7 +4,7 @@
 
 """C Structure representation of the CloneCD .img format."""
 
-from ctypes import c_ubyte, Structure, Union
+from ctypes import c_ubyte, sizeof, Structure, Union
 
 DATA_SIZE = 2048
 
@@ -60,3 +60,27 @@ class ccd_sector(Structure):
         ('sectheader', ccd_sectheader),
         ('content', ccd_content),
     ]
+
+
+class ccd_sector_mode1(Structure):
+    """Sector known to be in mode 1, without going through ccd_content."""
+    _fields_ = [
+        ('sectheader', ccd_sectheader),
+        ('content', ccd_mode1),
+    ]
+
+
+class ccd_sector_mode2(Structure):
+    """Sector known to be in mode 2, without going through ccd_content."""
+    _fields_ = [
+        ('sectheader', ccd_sectheader),
+        ('content', ccd_mode2),
+    ]
+
+
+SECTOR_SIZE = sizeof(ccd_sector)
+
+# Byte offsets within a sector, for reading raw sectors without ctypes
+MODE_OFFSET = ccd_sector.sectheader.offset + ccd_sectheader.header.offset + ccd_sectheader_header.mode.offset
+MODE1_DATA_OFFSET = ccd_sector_mode1.content.offset + ccd_mode1.data.offset
+MODE2_DATA_OFFSET = ccd_sector_mode2.content.offset + ccd_mode2.data.offset
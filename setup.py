@@ -19,6 +19,22 @@ def get_version(rel_path):
     else:
         raise RuntimeError("Unable to find version string.")
 
+# The compiled sector loop is optional, ccd2iso falls back to Python without it.
+# Without Cython, build from the C file shipped in the sdist if there is one.
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    if os.path.exists('ccd2iso/_core.c'):
+        ext_modules = [
+            setuptools.Extension('ccd2iso._core', ['ccd2iso/_core.c'], optional=True),
+        ]
+    else:
+        ext_modules = []
+else:
+    ext_modules = cythonize([
+        setuptools.Extension('ccd2iso._core', ['ccd2iso/_core.pyx'], optional=True),
+    ])
+
 with open('README.md', 'r') as readme:
     long_description = readme.read()
 
@@ -39,9 +55,13 @@ setuptools.setup(
         'Programming Language :: Python :: 3',
     ],
     packages=setuptools.find_packages(),
+    ext_modules=ext_modules,
     install_requires=[
         'progressbar2>=3.51',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     python_requires='>=3.8',
     entry_points={
         'console_scripts': ['ccd2iso = ccd2iso:main'],